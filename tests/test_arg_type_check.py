@@ -0,0 +1,23 @@
+import numpy as np
+import pytest
+
+from whobpyt.functions.arg_type_check import method_arg_type_check
+
+
+def _train(u: np.ndarray, num_epochs: int, learningrate: float = 0.05, lr_scheduler: bool = False):
+    method_arg_type_check(_train, exclude=['u'])
+
+
+def test_numeric_arguments_pass():
+    _train(None, 3, 1)
+    _train(None, np.int64(3), np.float64(0.01), True)
+
+
+@pytest.mark.parametrize("num_epochs, learningrate", [(3.0, 0.05), (True, 0.05), (3, "0.05"), (3, False)])
+def test_mistyped_argument_is_rejected(num_epochs, learningrate):
+    with pytest.raises(ValueError):
+        _train(None, num_epochs, learningrate)
+
+
+def test_excluded_argument_is_not_checked():
+    _train("not a tensor", 3)
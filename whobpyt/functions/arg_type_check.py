@@ -1,27 +1,49 @@
 #Authors: Kevin Kadak, ChatGPT
 
-import inspect
+import sys
+import numbers
+import functools
+import typing
 
-def method_arg_type_check(method_obj, exclude = []):
+# Numeric hints are checked against the abstract number types, so e.g. an int or np.float64 passes a float hint
+# and np.int64 passes an int hint. bool is rejected for both, even though it subclasses int.
+_NUMERIC_TYPES = {float: numbers.Real, int: numbers.Integral}
+
+@functools.lru_cache(maxsize=None)
+def _sig_hints(func_obj):
+    """
+    Returns the (cached) type hints of a function object, so the annotations are only resolved once per function.
     """
-    Takes the method object of a given function (e.g. RNNJANSEN) and checks that the passed arguments abide by their 
+    return typing.get_type_hints(func_obj)
+
+def method_arg_type_check(method_obj, exclude = [], caller_locals = None):
+    """
+    Takes the method object of a given function (e.g. RNNJANSEN) and checks that the passed arguments abide by their
     expected data types.  If there is a discrepency, raises a ValueError.
-    
+
     Optional argument: exclude
-        List of strings containing argument names to exclude from the check (e.g. ['step_size', 'params']).  
+        List of strings containing argument names to exclude from the check (e.g. ['step_size', 'params']).
         'self' is excluded automatically.
+    Optional argument: caller_locals
+        Dictionary of the passed arguments. Defaults to the local variables of the calling frame, so this
+        function should be called at the start of the method being checked.
     """
     #This function is based on code generated by ChatGPT
-    
-    exclude.append('self')
 
-    args_signature = inspect.signature(method_obj)
-    expected_types = {param.name: param.annotation for param in args_signature.parameters.values() if param.name not in exclude} # Extract expected parameter types from the signature
+    if caller_locals is None:
+        caller_locals = sys._getframe(1).f_locals
 
-    for arg_name, arg_type in expected_types.items(): # Iterate through each passed arguments' label and data type
-        if arg_name in locals(): # Skip 'self' argument and check if argument is present
-            if not isinstance(locals()[arg_name], arg_type): # Check if the passed arg's data type does not match its expected type
-                passed_arg_type = type(locals()[arg_name]).__name__ # Passed data type
-                expected_arg_type = arg_type.__name__ # Expected data type
-                raise ValueError(f"{arg_name} should be of type {expected_arg_type}, but got type {passed_arg_type} instead.") # Halt if discrepancy
+    expected_types = _sig_hints(getattr(method_obj, '__func__', method_obj)) # Bound methods are cached by their underlying function
 
+    for arg_name, arg_type in expected_types.items(): # Iterate through each annotated arguments' label and data type
+        if arg_name == 'self' or arg_name == 'return' or arg_name in exclude or arg_name not in caller_locals: # Skip 'self' argument and check if argument is present
+            continue
+        arg_value = caller_locals[arg_name]
+        if arg_type in _NUMERIC_TYPES:
+            type_ok = isinstance(arg_value, _NUMERIC_TYPES[arg_type]) and not isinstance(arg_value, bool)
+        else:
+            type_ok = isinstance(arg_value, arg_type)
+        if not type_ok: # Check if the passed arg's data type does not match its expected type
+            passed_arg_type = type(arg_value).__name__ # Passed data type
+            expected_arg_type = arg_type.__name__ # Expected data type
+            raise ValueError(f"{arg_name} should be of type {expected_arg_type}, but got type {passed_arg_type} instead.") # Halt if discrepancy
@@ -22,7 +22,8 @@ from torch.linalg import norm as ptnorm
 from torch import (tensor as pttensor, float32 as ptfloat32, sum as ptsum, exp as ptexp, diag as ptdiag, 
                    transpose as pttranspose, zeros_like as ptzeros_like, int64 as ptint64, randn as ptrandn, 
                    matmul as ptmatmul, tanh as pttanh, matmul as ptmatmul, reshape as ptreshape, sqrt as ptsqrt,
-                   ones as ptones, cat as ptcat)
+                   ones as ptones, cat as ptcat, is_grad_enabled as ptis_grad_enabled)
+from torch.utils.checkpoint import checkpoint as ptcheckpoint
 
 # Numpy stuff
 from numpy.random import uniform 
@@ -173,7 +174,7 @@ class JansenRitModel(AbstractNeuralModel):
     setModelParameters(self):    
         Sets the parameters of the model.
     
-    forward(input, noise_out, hx)
+    forward(external, hx, hE, checkpoint_TRs=0)
         Forward pass for generating a number of EEG signals with current model parameters
     
     """
@@ -323,7 +324,7 @@ class JansenRitModel(AbstractNeuralModel):
         
 
 
-    def forward(self, external, hx, hE):
+    def forward(self, external, hx, hE, checkpoint_TRs=0):
         """
         This function carries out the forward Euler integration method for the JR neural mass model,
         with time delays, connection gains, and external inputs considered. Each population (pyramidal,
@@ -338,6 +339,10 @@ class JansenRitModel(AbstractNeuralModel):
             Optional tensor of shape (batch_size, state_size, num_ROIs) representing the initial hidden state.
         hE : Optional[torch.Tensor]
             Optional tensor of shape (batch_size, num_ROIs, delays_max) representing the initial delays.
+        checkpoint_TRs : int
+            If larger than 0 (and smaller than TRs_per_window), the window is integrated in chunks of this many sample points
+            with gradient checkpointing: only the states at the chunk boundaries are kept for backpropagation, and each chunk
+            is recomputed during the backward pass. The gradients are unchanged. 0 (default) integrates without checkpointing.
 
         Returns
         -------
@@ -428,140 +433,171 @@ class JansenRitModel(AbstractNeuralModel):
         # Placeholder for the updated current state
         current_state = ptzeros_like(hx)
 
-        # Initializing lists for the history of the M/EEG signals, as well as each population's current and voltage.
-        E_window   = [];     I_window  = [];  P_window = [];
-        Ev_window  = [];     Iv_window = []; Pv_window = [];
-        eeg_window = []; states_window = [];
+        # Draw the stochastic input of the P, E and I populations for the whole window at once, 
+        # rather than three small draws at every integration step
+        noise_window = ptrandn(self.TRs_per_window, self.steps_per_TR, 3, n_nodes, 1)
 
-        # Use the model to get M/EEG signal at the i-th element in the window.
+        # Lead field matrix (the same for every sample point of the window)
+        onesmat = ptones(1,n_chans)
+        lm_t = (lm.T / ptsqrt((lm ** 2).sum(1))).T
+        self.lm_t = (lm_t - 1 / n_chans * ptmatmul(onesmat, lm_t))
 
-        # Run through the number of specified sample points for this window 
-        for i_window in range(self.TRs_per_window):
+        def integrate_TRs(tr_start, tr_end, P, E, I, Pv, Ev, Iv, hE):
+            """
+            Integrates the model over the sample points tr_start to tr_end of this window, returning the states and
+            delay history at the end, followed by the history of each population and the M/EEG over these sample points.
+            """
+
+            # hE is written in-place below, so work on a copy to leave the caller's (or the checkpoint's) input unchanged
+            hE = hE.clone()
+
+            # Initializing lists for the history of the M/EEG signals, as well as each population's current and voltage.
+            E_window   = [];     I_window  = [];  P_window = [];
+            Ev_window  = [];     Iv_window = []; Pv_window = [];
+            eeg_window = [];
+
+            # Use the model to get M/EEG signal at the i-th element in the window.
+
+            # Run through the number of specified sample points for this window 
+            for i_window in range(tr_start, tr_end):
             
 
-            # For each sample point, run the model by solving the differential 
-            # equations for a defined number of integration steps, 
-            # and keep only the final activity state within this set of steps 
-            for step_i in range(self.steps_per_TR):
+                # For each sample point, run the model by solving the differential 
+                # equations for a defined number of integration steps, 
+                # and keep only the final activity state within this set of steps 
+                for step_i in range(self.steps_per_TR):
                 
-                # Collect the delayed inputs:
+                    # Collect the delayed inputs:
 
-                # i) index the history of E
-                Ed = pttranspose(hE.clone().gather(1,self.delays), 0, 1)
+                    # i) index the history of E
+                    Ed = pttranspose(hE.clone().gather(1,self.delays), 0, 1)
 
-                # ii) multiply the past states by the connectivity weights matrix, and sum over rows
-                LEd_p2e =  ptsum(w_n_f * Ed, 1)
-                LEd_p2i = -ptsum(w_n_b * Ed, 1)
-                LEd_p2p =  ptsum(w_n_l * Ed, 1)
+                    # ii) multiply the past states by the connectivity weights matrix, and sum over rows
+                    LEd_p2e =  ptsum(w_n_f * Ed, 1)
+                    LEd_p2i = -ptsum(w_n_b * Ed, 1)
+                    LEd_p2p =  ptsum(w_n_l * Ed, 1)
                 
-                # iii) reshape for next step
-                LEd_p2e = ptreshape(LEd_p2e, (n_nodes, 1))
-                LEd_p2i = ptreshape(LEd_p2i, (n_nodes, 1))
-                LEd_p2p = ptreshape(LEd_p2p, (n_nodes, 1))
+                    # iii) reshape for next step
+                    LEd_p2e = ptreshape(LEd_p2e, (n_nodes, 1))
+                    LEd_p2i = ptreshape(LEd_p2i, (n_nodes, 1))
+                    LEd_p2p = ptreshape(LEd_p2p, (n_nodes, 1))
                 
-                # iv) if specified, add the laplacian component (self-connections from diagonals)
-                if self.use_laplacian:
-                    LEd_p2e =  LEd_p2e + ptmatmul(dg_f, E - I)
-                    LEd_p2i =  LEd_p2i - ptmatmul(dg_b, E - I)
-                    LEd_p2p =  LEd_p2p + ptmatmul(dg_l, P)
-
-                # External input (e.g. TMS, sensory)
-                u = external[:, step_i:step_i + 1, i_window]
+                    # iv) if specified, add the laplacian component (self-connections from diagonals)
+                    if self.use_laplacian:
+                        LEd_p2e =  LEd_p2e + ptmatmul(dg_f, E - I)
+                        LEd_p2i =  LEd_p2i - ptmatmul(dg_b, E - I)
+                        LEd_p2p =  LEd_p2p + ptmatmul(dg_l, P)
+
+                    # External input (e.g. TMS, sensory)
+                    u = external[:, step_i:step_i + 1, i_window]
                
-                # Stochastic / noise term
-                P_noise = std_in * ptrandn(n_nodes, 1) 
-                E_noise = std_in * ptrandn(n_nodes, 1)
-                I_noise = std_in * ptrandn(n_nodes, 1)
-
-                # Compute the firing rate for each neural populatin 
-                # at every node using the wave-to-pulse (sigmoid) functino
-                # (vmax = max value of sigmoid, v0 = midpoint of sigmoid)
-                P_sigm = vmax / ( 1 + ptexp ( r*(v0 -  (E-I) ) ) )
-                E_sigm = vmax / ( 1 + ptexp ( r*(v0 - (c1*P) ) ) )
-                I_sigm = vmax / ( 1 + ptexp ( r*(v0 - (c3*P) ) ) )
-
-                # Sum the four different input types into a single input value for each neural 
-                # populatin state variable
-                # The four input types are:
-                # - Local      (L)      - from other neural populations within a node (E->P,P->I, etc.)
-                # - Long-range (L-R)    - from other nodes in the network, weighted by the long-range 
-                #                         connectivity matrices, and time-delayed
-                # - Noise      (N)      - stochastic noise input
-                # - External   (E)      - external stimulation, eg from TMS or sensory stimulus
-                #
-                #        Local    Long-range   Noise   External
-                rP =     P_sigm  + g*LEd_p2p   + P_noise + k*ki*u 
-                rE =  c2*E_sigm  + g_f*LEd_p2e + E_noise          
-                rI =  c4*I_sigm  + g_b*LEd_p2i + I_noise          
-
-                # Apply some additional scaling
-                rP = u_2ndsys_ub * pttanh(rP / u_2ndsys_ub)
-                rE = u_2ndsys_ub * pttanh(rE / u_2ndsys_ub)
-                rI = u_2ndsys_ub * pttanh(rI / u_2ndsys_ub)
+                    # Stochastic / noise term
+                    P_noise = std_in * noise_window[i_window, step_i, 0]
+                    E_noise = std_in * noise_window[i_window, step_i, 1]
+                    I_noise = std_in * noise_window[i_window, step_i, 2]
+
+                    # Compute the firing rate for each neural populatin 
+                    # at every node using the wave-to-pulse (sigmoid) functino
+                    # (vmax = max value of sigmoid, v0 = midpoint of sigmoid)
+                    P_sigm = vmax / ( 1 + ptexp ( r*(v0 -  (E-I) ) ) )
+                    E_sigm = vmax / ( 1 + ptexp ( r*(v0 - (c1*P) ) ) )
+                    I_sigm = vmax / ( 1 + ptexp ( r*(v0 - (c3*P) ) ) )
+
+                    # Sum the four different input types into a single input value for each neural 
+                    # populatin state variable
+                    # The four input types are:
+                    # - Local      (L)      - from other neural populations within a node (E->P,P->I, etc.)
+                    # - Long-range (L-R)    - from other nodes in the network, weighted by the long-range 
+                    #                         connectivity matrices, and time-delayed
+                    # - Noise      (N)      - stochastic noise input
+                    # - External   (E)      - external stimulation, eg from TMS or sensory stimulus
+                    #
+                    #        Local    Long-range   Noise   External
+                    rP =     P_sigm  + g*LEd_p2p   + P_noise + k*ki*u 
+                    rE =  c2*E_sigm  + g_f*LEd_p2e + E_noise          
+                    rI =  c4*I_sigm  + g_b*LEd_p2i + I_noise          
+
+                    # Apply some additional scaling
+                    rP = u_2ndsys_ub * pttanh(rP / u_2ndsys_ub)
+                    rE = u_2ndsys_ub * pttanh(rE / u_2ndsys_ub)
+                    rI = u_2ndsys_ub * pttanh(rI / u_2ndsys_ub)
                 
-                # Compute d/dt   ('_tp1' = state variable at time t+1) 
-                P_tp1 =  P + dt * Pv
-                E_tp1 =  E + dt * Ev
-                I_tp1 =  I + dt * Iv
-                Pv_tp1 = Pv + dt * ( A*a*rP  -  2*a*Pv  -  a**2 * P )
-                Ev_tp1 = Ev + dt * ( A*a*rE  -  2*a*Ev  -  a**2 * E )
-                Iv_tp1 = Iv + dt * ( B*b*rI  -  2*b*Iv  -  b**2 * I )
-
-                # Add some additional saturation on the model states
-                # (for stability and gradient calculation).
-                P_tp1 = 1000*pttanh(P_tp1/1000)
-                E_tp1 = 1000*pttanh(E_tp1/1000)
-                I_tp1 = 1000*pttanh(I_tp1/1000)
-                Pv_tp1 = 1000*pttanh(Pv_tp1/1000)
-                Ev_tp1 = 1000*pttanh(Ev_tp1/1000)
-                Iv_tp1 = 1000*pttanh(Iv_tp1/1000)
+                    # Compute d/dt   ('_tp1' = state variable at time t+1) 
+                    P_tp1 =  P + dt * Pv
+                    E_tp1 =  E + dt * Ev
+                    I_tp1 =  I + dt * Iv
+                    Pv_tp1 = Pv + dt * ( A*a*rP  -  2*a*Pv  -  a**2 * P )
+                    Ev_tp1 = Ev + dt * ( A*a*rE  -  2*a*Ev  -  a**2 * E )
+                    Iv_tp1 = Iv + dt * ( B*b*rI  -  2*b*Iv  -  b**2 * I )
+
+                    # Add some additional saturation on the model states
+                    # (for stability and gradient calculation).
+                    P_tp1 = 1000*pttanh(P_tp1/1000)
+                    E_tp1 = 1000*pttanh(E_tp1/1000)
+                    I_tp1 = 1000*pttanh(I_tp1/1000)
+                    Pv_tp1 = 1000*pttanh(Pv_tp1/1000)
+                    Ev_tp1 = 1000*pttanh(Ev_tp1/1000)
+                    Iv_tp1 = 1000*pttanh(Iv_tp1/1000)
                 
-                # Update placeholders for pyramidal buffer
-                hE[:, 0] = P_tp1[:, 0]
+                    # Update placeholders for pyramidal buffer
+                    hE[:, 0] = P_tp1[:, 0]
             
-                # Set state variables to currrent values for next round of the loop
-                P = P_tp1
-                E = E_tp1
-                I = I_tp1
-                Pv = Pv_tp1
-                Ev = Ev_tp1
-                Iv = Iv_tp1
-                # (note - we do this because we aren't (explicitly) keeping the history 
-                # by doing something like P[t+1] = P + dt*Pv 
-                # because (for the purpose of the paramer estimation) we don't want to 
-                # keep the entire integration loop history of P
-                #
-
-                # *end 'step_i' loop*
-
-            # Capture the states at the end of every window in the placeholders for checking them visually
-            P_window.append(P);    I_window.append(I) ;  E_window.append(E)
-            Pv_window.append(Pv);  Iv_window.append(Iv); Ev_window.append(Ev)
+                    # Set state variables to currrent values for next round of the loop
+                    P = P_tp1
+                    E = E_tp1
+                    I = I_tp1
+                    Pv = Pv_tp1
+                    Ev = Ev_tp1
+                    Iv = Iv_tp1
+                    # (note - we do this because we aren't (explicitly) keeping the history 
+                    # by doing something like P[t+1] = P + dt*Pv 
+                    # because (for the purpose of the paramer estimation) we don't want to 
+                    # keep the entire integration loop history of P
+                    #
+
+                    # *end 'step_i' loop*
+
+                # Capture the states at the end of every window in the placeholders for checking them visually
+                P_window.append(P);    I_window.append(I) ;  E_window.append(E)
+                Pv_window.append(Pv);  Iv_window.append(Iv); Ev_window.append(Ev)
             
-            # Capture the states at every tr in the placeholders for checking them visually.
-            hE = ptcat([P, hE[:, :-1]], dim=1)  # update placeholders for pyramidal buffer
-
-            # Lead field matrix
-            onesmat = ptones(1,n_chans)
-            lm_t = (lm.T / ptsqrt((lm ** 2).sum(1))).T
-            self.lm_t = (lm_t - 1 / n_chans * ptmatmul(onesmat, lm_t))
-
-            # Compute M/EEG window
-            temp = cy0 * ptmatmul(self.lm_t, E-I) - 1 * y0
-            eeg_window.append(temp)
-
-            # *end 'i_window' loop
+                # Capture the states at every tr in the placeholders for checking them visually.
+                hE = ptcat([P, hE[:, :-1]], dim=1)  # update placeholders for pyramidal buffer
+
+                # Compute M/EEG window
+                temp = cy0 * ptmatmul(self.lm_t, E-I) - 1 * y0
+                eeg_window.append(temp)
+
+                # *end 'i_window' loop
+
+            return (P, E, I, Pv, Ev, Iv, hE,
+                    ptcat(P_window, dim=1), ptcat(E_window, dim=1), ptcat(I_window, dim=1),
+                    ptcat(Pv_window, dim=1), ptcat(Ev_window, dim=1), ptcat(Iv_window, dim=1),
+                    ptcat(eeg_window, dim=1))
+
+        # Integrate the window in chunks of checkpoint_TRs sample points when checkpointing is used (and gradients are recorded),
+        # so only the states at the chunk boundaries are kept for backpropagation and each chunk is recomputed during backward.
+        # Otherwise the window is integrated as a single chunk.
+        use_checkpoint = checkpoint_TRs > 0 and checkpoint_TRs < self.TRs_per_window and ptis_grad_enabled()
+        chunk_TRs = checkpoint_TRs if use_checkpoint else self.TRs_per_window
+
+        window_names = ['P', 'E', 'I', 'Pv', 'Ev', 'Iv', 'eeg']
+        window_chunks = {name: [] for name in window_names}
+        for tr_start in range(0, self.TRs_per_window, chunk_TRs):
+            tr_end = min(tr_start + chunk_TRs, self.TRs_per_window)
+            if use_checkpoint:
+                chunk = ptcheckpoint(integrate_TRs, tr_start, tr_end, P, E, I, Pv, Ev, Iv, hE, use_reentrant=False)
+            else:
+                chunk = integrate_TRs(tr_start, tr_end, P, E, I, Pv, Ev, Iv, hE)
+            P, E, I, Pv, Ev, Iv, hE = chunk[:7]
+            for name, values in zip(window_names, chunk[7:]):
+                window_chunks[name].append(values)
 
         # Update the current state.
         current_state = ptcat([P, E, I, Pv, Ev, Iv], dim=1)
         next_state['current_state'] = current_state
-        next_state['eeg'] = ptcat(eeg_window, dim=1)
-        next_state['E'] = ptcat(E_window, dim=1)
-        next_state['I'] = ptcat(I_window, dim=1)
-        next_state['P'] = ptcat(P_window, dim=1)
-        next_state['Ev'] = ptcat(Ev_window, dim=1)
-        next_state['Iv'] = ptcat(Iv_window, dim=1)
-        next_state['Pv'] = ptcat(Pv_window, dim=1)
+        for name in window_names:
+            next_state[name] = ptcat(window_chunks[name], dim=1)
 
 
         return next_state, hE
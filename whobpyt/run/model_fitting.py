@@ -12,7 +12,63 @@ from ..datatypes import TrainingStats
 #from whobpyt.models.RWW.RWW_np import RWW_np #This should be removed and made general
 from ..functions.arg_type_check import method_arg_type_check
 import pickle
-from sklearn.metrics.pairwise import cosine_similarity
+
+
+def _fused_adam(params, lr):
+    """
+    Returns an Adam optimizer whose element-wise update is fused into a single kernel (fused for parameters on CUDA, 
+    foreach otherwise), falling back to the default implementation for PyTorch versions which do not support these options.
+    """
+    fuse_arg = {}
+    if len(params) > 0: # an empty list is left for Adam to reject
+        fuse_arg = {'fused': True} if params[0].device.type == 'cuda' else {'foreach': True}
+    try:
+        return optim.Adam(params, lr=lr, eps=1e-7, **fuse_arg)
+    except TypeError: # keyword not supported by this PyTorch version
+        return optim.Adam(params, lr=lr, eps=1e-7)
+
+
+def _rowwise_cosine(a, b, eps=1e-12):
+    """
+    Returns the cosine similarity between each row of a and the same row of b
+    (the diagonal of sklearn's cosine_similarity(a, b), without computing the full matrix).
+    """
+    return (a * b).sum(1) / (np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1) + eps)
+
+
+def _to_device(data, device):
+    """
+    Returns data (a NumPy array or Tensor) as a contiguous float32 tensor on device. 
+    When copying from the host to a GPU the data is staged in pinned memory, so the copy is issued asynchronously.
+    """
+    data = torch.as_tensor(data, dtype=torch.float32).contiguous()
+    if device.type == 'cuda' and data.device.type == 'cpu':
+        return data.pin_memory().to(device, non_blocking=True)
+    return data.to(device)
+
+
+def _model_device(model, init_state):
+    """
+    Returns the device the model simulates on: the device of its parameters, or of its initial state (from createIC()) 
+    if the model has no parameters. Data fed into model.forward() has to be placed on this device.
+    """
+    try:
+        return next(model.parameters()).device
+    except StopIteration:
+        return init_state.device
+
+
+def _write_window(windDict, next_window, names, win_idx, num_windows):
+    """
+    Writes one window of the simulated states and outputs into the time series of the entire recording (windDict).
+    The time series are allocated at the first window, once the length of a window of each variable is known.
+    """
+    for name in names:
+        window = next_window[name].detach()
+        window_len = window.shape[1]
+        if win_idx == 0:
+            windDict[name] = window.new_empty((window.shape[0], num_windows * window_len))
+        windDict[name][:, win_idx * window_len:(win_idx + 1) * window_len] = window
 
 
 class ModelFitting(AbstractFitting):
@@ -73,7 +129,9 @@ class ModelFitting(AbstractFitting):
             pickle.dump(self, f)
 
     def train(self, u, empRecs: list, 
-              num_epochs: int, TPperWindow: int, warmupWindow: int = 0, learningrate: float = 0.05, lr_2ndLevel: float = 0.05, lr_scheduler: bool = False):
+              num_epochs: int, TPperWindow: int, warmupWindow: int = 0, learningrate: float = 0.05, lr_2ndLevel: float = 0.05, lr_scheduler: bool = False, 
+              compile_model: bool = False, bf16_autocast: bool = False, log_every: int = 1, 
+              checkpoint_TRs: int = 0):
         """
         Parameters
         ----------
@@ -91,23 +149,81 @@ class ModelFitting(AbstractFitting):
             learning rate for priors of model parameters, and possibly others
         lr_scheduler: bool
             Whether to use the learning rate scheduler
+        compile_model: bool
+            Whether to compile model.forward with torch.compile (PyTorch >= 2.0), fusing the small operations of the numerical solver
+        bf16_autocast: bool
+            Whether to run model.forward under BF16 autocast. The simulated outputs are returned in FP32, so the loss is computed in FP32
+        log_every: int
+            Print the fit statistics (Pseudo FC_cor, cos_sim) of every log_every-th epoch and of the last epoch. 
+            Must be at least 1, otherwise a ValueError is raised
+        checkpoint_TRs: int
+            If larger than 0, passed to model.forward to integrate each training window in checkpointed chunks of this many
+            sample points, trading recomputation during backpropagation for memory (the model has to support it, e.g. JansenRitModel)
         """            
         method_arg_type_check(self.train, exclude = ['u']) # Check that the passed arguments (excluding self) abide by their expected data types
+        if log_every < 1:
+            raise ValueError(f"log_every should be at least 1, but got {log_every} instead.")
+
+        # Names of the simulated states and outputs, collected once for all the loops below
+        sim_names = tuple(set(self.model.state_names + self.model.output_names))
 
         # Define two different optimizers for each group
-        modelparameter_optimizer = optim.Adam(self.model.params_fitted['modelparameter'], lr=learningrate, eps=1e-7)
-        hyperparameter_optimizer = optim.Adam(self.model.params_fitted['hyperparameter'], lr=lr_2ndLevel, eps=1e-7)
+        modelparameter_optimizer = _fused_adam(self.model.params_fitted['modelparameter'], learningrate)
+        hyperparameter_optimizer = _fused_adam(self.model.params_fitted['hyperparameter'], lr_2ndLevel)
+
+        # The forward model used for training, optionally compiled (the model itself is kept uncompiled, so saving and parameter names are unaffected)
+        if compile_model:
+            forward_model = torch.compile(self.model, fullgraph=False)
+        else:
+            forward_model = self.model
+
+        # Only pass checkpoint_TRs when used, so models without gradient checkpointing support can still be trained
+        forward_kwargs = {'checkpoint_TRs': checkpoint_TRs} if checkpoint_TRs > 0 else {}
+
+        def model_forward(external, X, hE):
+            # Run one window of the forward model, optionally under BF16 autocast (keyed to the device the model simulates on)
+            with torch.autocast(device_type=sim_device.type, dtype=torch.bfloat16, enabled=bf16_autocast):
+                next_window, hE_new = forward_model(external, X, hE, **forward_kwargs)
+            if bf16_autocast:
+                next_window = {name: value.float() for name, value in next_window.items()}
+                hE_new = hE_new.float()
+            return next_window, hE_new
+
+        # Window the recordings once, they are the same in every epoch
+        # NOTE: Recordings are not run as a batch dimension through the model, as model.forward() has no batch dimension 
+        #       and the state at the end of one recording is the initial state of the next. See FittingBatch for batched training.
+        windowedRecs = [empRec.windowedTensor(TPperWindow) for empRec in empRecs]
+
+        # initial state
+        X = self.model.createIC(ver = 0)
+        # initials of history of E
+        hE = self.model.createDelayIC(ver = 0)
+
+        # The device the model simulates on, on which all data fed into the model and the cost is placed
+        sim_device = _model_device(self.model, X)
+
+        # place the windowed recordings on the device once, so that each window is a slice rather than a new tensor
+        windowedRecTensors = [_to_device(windowedTS, sim_device) for windowedTS in windowedRecs]
+
+        # Number of training windows (i.e. backpropagations) in one epoch
+        windows_per_epoch = sum(windowedTS.shape[0] for windowedTS in windowedRecs)
+
+        # define mask for getting lower triangle matrix indices of the (output) FC
+        mask_e = np.tril_indices(self.model.output_size, -1)
+
+        # Empirical time series and lower triangle of the FC of each recording, which do not change over training
+        # (num_windows x num_regions x window_length -> num_regions x ts_length)
+        empTSs = [windowedTS.transpose(1, 0, 2).reshape(windowedTS.shape[1], -1) for windowedTS in windowedRecs]
+        empFCs_tril = [np.corrcoef(ts_emp)[mask_e] for ts_emp in empTSs]
 
         # Define the learning rate schedulers for each group of parameters
 
         if lr_scheduler:
-            total_steps = 0
-            for empRec in empRecs:
-                total_steps += int(empRec.length/TPperWindow)*num_epochs
+            total_steps = windows_per_epoch*num_epochs
         
             # total_steps = self.num_windows*num_epochs
             hyperparameter_scheduler = optim.lr_scheduler.OneCycleLR(hyperparameter_optimizer, 
-                                                                     lr_hyper, 
+                                                                     lr_2ndLevel, 
                                                                      total_steps, 
                                                                      anneal_strategy = "cos")
             hlrs = []
@@ -116,15 +232,15 @@ class ModelFitting(AbstractFitting):
                                                                      total_steps, 
                                                                      anneal_strategy = "cos")
             mlrs = []
-        
-        # initial state
-        X = self.model.createIC(ver = 0)
-        # initials of history of E
-        hE = self.model.createDelayIC(ver = 0)
 
-        # define masks for getting lower triangle matrix indices
-        mask = np.tril_indices(self.model.node_size, -1)
-        mask_e = np.tril_indices(self.model.output_size, -1)
+        # initial the external inputs once, and slice the stimulus (if any) per window instead of copying it
+        zero_external = torch.zeros(self.model.node_size, self.model.steps_per_TR, self.model.TRs_per_window, device=sim_device)
+        u_tensor = None if isinstance(u, int) else _to_device(u, sim_device)
+
+        # TRAINING_STATS: the parameters to record every epoch, collected once rather than rebuilding state_dict() each epoch
+        exclude_param = ['gains_con', 'lm'] #This stores SC and LF which are saved seperately
+        tracked_vars = [(par_name, getattr(self.model.params, par_name)) for par_name in self.model.track_params]
+        tracked_tensors = [(key, value) for key, value in self.model.named_parameters() if key not in exclude_param]
         
         # LOOP 1/4: Number of Training Epochs
         for i_epoch in range(num_epochs):
@@ -137,64 +253,61 @@ class ModelFitting(AbstractFitting):
                 warmup_windows = warmupWindow
         
             # TRAINING_STATS: placeholders for the history of trainingStats
-            loss_his = []  # loss placeholder to take the average for the epoch at the end of the epoch
+            loss_his = torch.empty(windows_per_epoch, device=sim_device)  # loss placeholder, filled per window, to take the average for the epoch at the end of the epoch
+            i_step = 0 # index of the training window within the epoch
 
             print("Epoch: ", i_epoch)
                    
             # LOOP 2/4: Number of Recordings in the Training Dataset
-            for empRec in empRecs: 
-                windowedTS = empRec.windowedTensor(TPperWindow)
+            for windowedTSTensor, ts_emp, fc_tril in zip(windowedRecTensors, empTSs, empFCs_tril): 
 
                 # TIME SERIES: Create placeholders for the simulated states and outputs of entire time series corresponding to one recording
-                windListDict = {} # A Dictionary with a List of windowed time series
-                for name in set(self.model.state_names + self.model.output_names):
-                    windListDict[name] = []
+                windListDict = {} # A Dictionary with a time series per state/output, filled in one window at a time
                 
                 # initial the external inputs
-                external = torch.tensor(
-                    np.zeros([self.model.node_size, self.model.steps_per_TR, self.model.TRs_per_window]),
-                    dtype=torch.float32)
+                external = zero_external
                 for TR_i in range(warmup_windows):
                 
 
 
 
                     # Use the model.forward() function to update next state and get simulated EEG in this batch.
-                    next_window, hE_new = self.model(external, X, hE)
+                    # (warmup windows are never backpropagated through, so no autograd graph is recorded for them)
+                    with torch.no_grad():
+                        next_window, hE_new = model_forward(external, X, hE)
                     #print(next_window['current_state'])
-                    X = torch.tensor(next_window['current_state'].detach().numpy(), dtype=torch.float32)
-                    hE = torch.tensor(hE_new.detach().numpy(), dtype=torch.float32)
+                    X = next_window['current_state'].detach()
+                    hE = hE_new.detach().clone() # cloned as model.forward() writes into hE in-place
                 # LOOP 3/4: Number of windowed segments for the recording
-                for win_idx in range(windowedTS.shape[0]):
+                for win_idx in range(windowedTSTensor.shape[0]):
 
-                    # Reset the gradient to zeros after update model parameters.
-                    hyperparameter_optimizer.zero_grad()
-                    modelparameter_optimizer.zero_grad()
+                    # Reset the gradient after update model parameters (set to None rather than writing zeros into every .grad).
+                    hyperparameter_optimizer.zero_grad(set_to_none=True)
+                    modelparameter_optimizer.zero_grad(set_to_none=True)
 
                     # if the external not empty
-                    if not isinstance(u, int):
-                        external = torch.tensor(
-                            (u[:, :, win_idx * self.model.TRs_per_window:(win_idx + 1) * self.model.TRs_per_window]), 
-                            dtype=torch.float32)
+                    if u_tensor is not None:
+                        external = u_tensor[:, :, win_idx * self.model.TRs_per_window:(win_idx + 1) * self.model.TRs_per_window]
 
                     # LOOP 4/4: The loop within the forward model (numerical solver), which is number of time points per windowed segment
-                    next_window, hE_new = self.model(external, X, hE)
+                    next_window, hE_new = model_forward(external, X, hE)
 
                     # Get the batch of empirical signal.
-                    ts_window = torch.tensor(windowedTS[win_idx, :, :], dtype=torch.float32)
+                    ts_window = windowedTSTensor[win_idx]
 
                     # calculating loss
                     loss, loss_main = self.cost.loss(next_window, ts_window)
                     
                     # TIME SERIES: Put the window of simulated forward model.
-                    for name in set(self.model.state_names + self.model.output_names):
-                        windListDict[name].append(next_window[name].detach().cpu().numpy())
+                    _write_window(windListDict, next_window, sim_names, win_idx, windowedTSTensor.shape[0])
 
                     # TRAINING_STATS: Adding Loss for every training window (corresponding to one backpropagation)
-                    loss_his.append(loss_main.detach().cpu().numpy())
+                    loss_his[i_step] = loss_main.detach()
+                    i_step += 1
 
                     # Calculate gradient using backward (backpropagation) method of the loss function.
-                    loss.backward(retain_graph=True)
+                    # (the graph is not retained, as X and hE are detached between windows and the priors are recomputed in every loss)
+                    loss.backward()
 
                     # Optimize the model based on the gradient method in updating the model parameters.
                     hyperparameter_optimizer.step()
@@ -211,45 +324,40 @@ class ModelFitting(AbstractFitting):
 
                     # last update current state using next state...
                     # (no direct use X = X_next, since gradient calculation only depends on one batch no history)
-                    X = next_window['current_state'].detach().clone() # dtype=torch.float32
-                    hE = hE_new.detach().clone() #dtype=torch.float32
-
-                ts_emp = np.concatenate(list(windowedTS),1) #TODO: Check this code
-                fc = np.corrcoef(ts_emp)
-
-                # TIME SERIES: Concatenate all windows together to get one recording
-                for name in set(self.model.state_names + self.model.output_names):
-                        windListDict[name] = np.concatenate(windListDict[name], axis=1)
-
-                ts_sim = windListDict[self.model.output_names[0]]
-                fc_sim = np.corrcoef(ts_sim[:, 10:])
-
-                print('epoch: ', i_epoch, 
-                      'loss:', loss_main.detach().cpu().numpy(),
-                      'Pseudo FC_cor: ', np.corrcoef(fc_sim[mask_e], fc[mask_e])[0, 1], #Calling this Pseudo as different windows of the time series have slighly different parameter values
-                      'cos_sim: ', np.diag(cosine_similarity(ts_sim, ts_emp)).mean())
-                      
-                if lr_scheduler:
-                    print('Modelparam_lr: ', modelparameter_scheduler.get_last_lr()[0])
-                    print('Hyperparam_lr: ', hyperparameter_scheduler.get_last_lr()[0])
+                    X = next_window['current_state'].detach()
+                    hE = hE_new.detach().clone() # cloned as model.forward() writes into hE in-place
+
+                # TIME SERIES: The time series of the entire recording as numpy arrays
+                for name in sim_names:
+                        windListDict[name] = windListDict[name].cpu().numpy()
+
+                # The FC and cosine similarity are only computed for the epochs which are printed
+                if (i_epoch % log_every == 0) or (i_epoch == num_epochs - 1):
+                    ts_sim = windListDict[self.model.output_names[0]]
+                    fc_sim = np.corrcoef(ts_sim[:, 10:])
+
+                    print('epoch: ', i_epoch, 
+                          'loss:', loss_main.detach().cpu().numpy(),
+                          'Pseudo FC_cor: ', np.corrcoef(fc_sim[mask_e], fc_tril)[0, 1], #Calling this Pseudo as different windows of the time series have slighly different parameter values
+                          'cos_sim: ', _rowwise_cosine(ts_sim, ts_emp).mean())
+                          
+                    if lr_scheduler:
+                        print('Modelparam_lr: ', modelparameter_scheduler.get_last_lr()[0])
+                        print('Hyperparam_lr: ', hyperparameter_scheduler.get_last_lr()[0])
                     
             # TRAINING_STATS: Put the updated model parameters into the history placeholders at the end of every epoch.
             # Additing Mean Loss for the Epoch
-            self.trainingStats.appendLoss(np.mean(loss_his))
+            self.trainingStats.appendLoss(np.mean(loss_his.cpu().numpy()))
             # NMM/Other Parameter info for the Epoch (a list where a number is recorded every window of every record)            
             trackedParam = {}
-            exclude_param = ['gains_con', 'lm'] #This stores SC and LF which are saved seperately
-            if(self.model.track_params):
-                for par_name in self.model.track_params:
-                    var = getattr(self.model.params, par_name)
-                    if (var.fit_par):
-                        trackedParam[par_name] = var.value().detach().cpu().numpy().copy()
-                    if (var.fit_hyper):
-                        trackedParam[par_name + "_prior_mean"] = var.prior_mean.detach().cpu().numpy().copy()
-                        trackedParam[par_name + "_prior_precision"] = var.prior_precision.detach().cpu().numpy().copy()
-            for key, value in self.model.state_dict().items():
-                if key not in exclude_param:
-                    trackedParam[key] = value.detach().cpu().numpy().ravel().copy()
+            for par_name, var in tracked_vars:
+                if (var.fit_par):
+                    trackedParam[par_name] = var.value().detach().cpu().numpy().copy()
+                if (var.fit_hyper):
+                    trackedParam[par_name + "_prior_mean"] = var.prior_mean.detach().cpu().numpy().copy()
+                    trackedParam[par_name + "_prior_precision"] = var.prior_precision.detach().cpu().numpy().copy()
+            for key, value in tracked_tensors:
+                trackedParam[key] = value.detach().cpu().numpy().ravel().copy()
             self.trainingStats.appendParam(trackedParam)
             # Saving the SC and/or Lead Field State at Every Epoch
 
@@ -266,16 +374,16 @@ class ModelFitting(AbstractFitting):
         
         # Saving the last recording of training as a Model_fitting attribute
         self.lastRec = {}
-        for name in set(self.model.state_names + self.model.output_names):
+        for name in sim_names:
             self.lastRec[name] = Recording(windListDict[name], step_size = self.model.step_size) #TODO: This won't work if different variables have different step sizes
 
-    def evaluate(self, u, empRec: list, TPperWindow: int, base_window_num: int = 0, transient_num: int = 10): 
+    def evaluate(self, u, empRec: Recording, TPperWindow: int, base_window_num: int = 0, transient_num: int = 10): 
         """
         Parameters
         ----------
         u : int or Tensor
             external or stimulus
-        empRec: list of Recording
+        empRec: Recording
             This is the ML "Training Labels"
         TPperWindow: int
             Number of Empirical Time Points per window. model.forward does one window at a time.  
@@ -288,64 +396,64 @@ class ModelFitting(AbstractFitting):
         method_arg_type_check(self.evaluate, exclude = ['u']) # Check that the passed arguments (excluding self) abide by their expected data types
         #TODO: Should be updated to take a list of u and empRec
 
+        # Names of the simulated states and outputs, collected once for all the loops below
+        sim_names = tuple(set(self.model.state_names + self.model.output_names))
+
         # initial state
         X = self.model.createIC(ver = 1)
         # initials of history of E
         hE = self.model.createDelayIC(ver = 1)
 
-        # define mask for getting lower triangle matrix
-        mask = np.tril_indices(self.model.node_size, -1)
+        # define mask for getting lower triangle matrix indices of the (output) FC
         mask_e = np.tril_indices(self.model.output_size, -1)
         
         # Create placeholders for the simulated states and outputs of entire time series corresponding to one recording
-        windListDict = {} # A Dictionary with a List of windowed time series
-        for name in set(self.model.state_names + self.model.output_names):
-            windListDict[name] = []
+        windListDict = {} # A Dictionary with a time series per state/output, filled in one window at a time
 
         num_windows = int(empRec.length/TPperWindow)
         u_hat = np.zeros(
             (self.model.node_size,self.model.steps_per_TR,
              base_window_num*self.model.TRs_per_window + num_windows*self.model.TRs_per_window))
         u_hat[:, :, base_window_num * self.model.TRs_per_window:] = u
+        u_hat = _to_device(u_hat, _model_device(self.model, X))
 
         # LOOP 1/2: The number of windows in a recording
         for win_idx in range(num_windows + base_window_num):
 
             # Get the input and output noises for the module.
-            external = torch.tensor(
-                (u_hat[:, :, win_idx * self.model.TRs_per_window:(win_idx + 1) * self.model.TRs_per_window]),
-                dtype=torch.float32)
+            external = u_hat[:, :, win_idx * self.model.TRs_per_window:(win_idx + 1) * self.model.TRs_per_window]
 
             # LOOP 2/2: The loop within the forward model (numerical solver), which is number of time points per windowed segment
-            next_window, hE_new = self.model.forward(external, X, hE)
+            # (no gradients are needed outside of training, so no autograd graph is recorded)
+            with torch.no_grad():
+                next_window, hE_new = self.model.forward(external, X, hE)
 
             # TIME SERIES: Put the window of simulated forward model.
             if win_idx > base_window_num - 1:
-                for name in set(self.model.state_names + self.model.output_names):
-                    windListDict[name].append(next_window[name].detach().cpu().numpy())
+                _write_window(windListDict, next_window, sim_names, win_idx - base_window_num, num_windows)
 
             # last update current state using next state...
             # (no direct use X = X_next, since gradient calculation only depends on one batch no history)
-            X = next_window['current_state'].detach().clone() # dtype=torch.float32
-            hE = hE_new.detach().clone() #dtype=torch.float32
+            X = next_window['current_state'].detach()
+            hE = hE_new.detach().clone() # cloned as model.forward() writes into hE in-place
         
         windowedTS = empRec.windowedTensor(TPperWindow)
-        ts_emp = np.concatenate(list(windowedTS),1) #TODO: Check this code
+        ts_emp = windowedTS.transpose(1, 0, 2).reshape(windowedTS.shape[1], -1) # (num_windows x num_regions x window_length -> num_regions x ts_length)
         fc = np.corrcoef(ts_emp)
         
-        # TIME SERIES: Concatenate all windows together to get one recording
-        for name in set(self.model.state_names + self.model.output_names):
-            windListDict[name] = np.concatenate(windListDict[name], axis=1)
+        # TIME SERIES: The time series of the entire recording as numpy arrays
+        for name in sim_names:
+            windListDict[name] = windListDict[name].cpu().numpy()
         
         ts_sim = windListDict[self.model.output_names[0]]
         fc_sim = np.corrcoef(ts_sim[:, transient_num:])
         
         print('FC_cor: ', np.corrcoef(fc_sim[mask_e], fc[mask_e])[0, 1], 
-              'cos_sim: ', np.diag(cosine_similarity(ts_sim, ts_emp)).mean())
+              'cos_sim: ', _rowwise_cosine(ts_sim, ts_emp).mean())
         
         # Saving the last recording of training as a Model_fitting attribute
         self.lastRec = {}
-        for name in set(self.model.state_names + self.model.output_names):
+        for name in sim_names:
             self.lastRec[name] = Recording(windListDict[name], step_size = self.model.step_size) #TODO: This won't work if different variables have different step sizes
 
     def simulate(self, u, numTP: int, base_window_num: int = 0, transient_num: int = 10):
@@ -364,6 +472,9 @@ class ModelFitting(AbstractFitting):
         """
         method_arg_type_check(self.simulate, exclude = ['u']) # Check that the passed arguments (excluding self) abide by their expected data types
 
+        # Names of the simulated states and outputs, collected once for all the loops below
+        sim_names = tuple(set(self.model.state_names + self.model.output_names))
+
         num_windows = 1
         TPperWindow = numTP #TODO: May want to go back to TPperWindow so base_window_num is used correctly, but also should be made consistent with train
 
@@ -372,49 +483,40 @@ class ModelFitting(AbstractFitting):
         # initials of history of E
         hE = self.model.createDelayIC(ver = 1)
 
-        # define mask for getting lower triangle matrix
-        mask = np.tril_indices(self.model.node_size, -1)
-        mask_e = np.tril_indices(self.model.output_size, -1)
-        
         # Create placeholders for the simulated states and outputs of entire time series corresponding to one recording
-        windListDict = {} # A Dictionary with a List of windowed time series
-        for name in set(self.model.state_names + self.model.output_names):
-            windListDict[name] = []
+        windListDict = {} # A Dictionary with a time series per state/output, filled in one window at a time
 
         u_hat = np.zeros(
             (self.model.node_size,self.model.steps_per_TR,
              base_window_num*self.model.TRs_per_window + num_windows*self.model.TRs_per_window))
         u_hat[:, :, base_window_num * self.model.TRs_per_window:] = u
+        u_hat = _to_device(u_hat, _model_device(self.model, X))
 
         # LOOP 1/2: The number of windows in a recording
         for win_idx in range(num_windows + base_window_num):
 
             # Get the input and output noises for the module.
-            external = torch.tensor(
-                (u_hat[:, :, win_idx * self.model.TRs_per_window:(win_idx + 1) * self.model.TRs_per_window]),
-                dtype=torch.float32)
+            external = u_hat[:, :, win_idx * self.model.TRs_per_window:(win_idx + 1) * self.model.TRs_per_window]
 
             # LOOP 2/2: The loop within the forward model (numerical solver), which is number of time points per windowed segment
-            next_window, hE_new = self.model.forward(external, X, hE)
+            # (no gradients are needed outside of training, so no autograd graph is recorded)
+            with torch.no_grad():
+                next_window, hE_new = self.model.forward(external, X, hE)
 
             # TIME SERIES: Put the window of simulated forward model.
             if win_idx > base_window_num - 1:
-                for name in set(self.model.state_names + self.model.output_names):
-                    windListDict[name].append(next_window[name].detach().cpu().numpy())
+                _write_window(windListDict, next_window, sim_names, win_idx - base_window_num, num_windows)
 
             # last update current state using next state...
             # (no direct use X = X_next, since gradient calculation only depends on one batch no history)
-            X = next_window['current_state'].detach().clone() # dtype=torch.float32
-            hE = hE_new.detach().clone() #dtype=torch.float32
+            X = next_window['current_state'].detach()
+            hE = hE_new.detach().clone() # cloned as model.forward() writes into hE in-place
         
-        # TIME SERIES: Concatenate all windows together to get one recording
-        for name in set(self.model.state_names + self.model.output_names):
-            windListDict[name] = np.concatenate(windListDict[name], axis=1)
-        
-        ts_sim = windListDict[self.model.output_names[0]]
-        fc_sim = np.corrcoef(ts_sim[:, transient_num:])
+        # TIME SERIES: The time series of the entire recording as numpy arrays
+        for name in sim_names:
+            windListDict[name] = windListDict[name].cpu().numpy()
         
         # Saving the last recording of training as a Model_fitting attribute
         self.lastRec = {}
-        for name in set(self.model.state_names + self.model.output_names):
+        for name in sim_names:
             self.lastRec[name] = Recording(windListDict[name], step_size = self.model.step_size) #TODO: This won't work if different variables have different step sizes